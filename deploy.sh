@@ -30,4 +30,4 @@ pip install --upgrade pip
 pip install -r "$PROJECT_ROOT/requirements.txt"
 
 export PYTHONPATH="$PROJECT_ROOT"
-uvicorn server.server:app --host 0.0.0.0 --port "${PORT:-8000}"
+uvicorn server.server:app --host 0.0.0.0 --port "${PORT:-8000}" --workers "${WEB_CONCURRENCY:-2}" --loop uvloop --ws websockets
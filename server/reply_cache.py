@@ -0,0 +1,142 @@
+"""剧情回复缓存。
+
+`BranchEngine` 每次请求 OpenAI 都要付出数秒延迟和 token 费用，而玩家经常
+会说出意思相同的话（例如“为什么”与“怎么会这样”）。本模块提供两级缓存：
+
+1. 精确缓存：以 ``sha256(model + messages + temperature)`` 为键，保存在进程
+   内的 LRU 中；配置了 ``REDIS_URL`` 且安装了 ``redis`` 时同时写入 Redis，
+   便于多个 worker 共享。采样温度较高时回复本就不可复现，因此不做精确缓存。
+2. 语义缓存：按“模型 + 系统提示词 + 历史记录”划分作用域，在同一作用域内
+   用 embedding 的余弦相似度查找相近的提问，超过阈值即直接复用回复。
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+
+
+def digest(*parts: Any) -> str:
+    """对任意可 JSON 序列化的内容计算稳定的 sha256 摘要。"""
+
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ReplyCache:
+    """精确 + 语义两级回复缓存。
+
+    Parameters
+    ----------
+    max_entries: int
+        进程内 LRU 与每个语义作用域保留的最大条目数。
+    similarity_threshold: float
+        语义命中所需的最低余弦相似度，默认 0.92。
+    max_exact_temperature: float
+        采样温度不高于该值时才启用精确缓存。
+    redis_url: Optional[str]
+        Redis 连接地址，为空时只使用进程内缓存。
+    ttl: int
+        写入 Redis 的过期时间（秒）。
+    """
+
+    def __init__(
+        self,
+        *,
+        max_entries: int = 512,
+        similarity_threshold: float = 0.92,
+        max_exact_temperature: float = 0.3,
+        redis_url: Optional[str] = None,
+        ttl: int = 24 * 3600,
+    ) -> None:
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.max_exact_temperature = max_exact_temperature
+        self.ttl = ttl
+        self._exact: OrderedDict[str, str] = OrderedDict()
+        self._semantic: OrderedDict[str, tuple[np.ndarray, list[str]]] = OrderedDict()
+        self._redis = None
+        if redis_url:
+            try:
+                from redis import asyncio as redis_asyncio  # type: ignore
+
+                self._redis = redis_asyncio.from_url(redis_url, decode_responses=True)
+            except Exception as exc:  # pragma: no cover - 依赖外部环境
+                print(f"[ReplyCache] 无法连接 Redis，仅使用进程内缓存: {exc}")
+
+    def exact_key(self, model: str, messages: list[dict[str, str]], temperature: float) -> Optional[str]:
+        if temperature > self.max_exact_temperature:
+            return None
+        return "live_galgame:reply:" + digest(model, messages, temperature)
+
+    async def get(self, key: Optional[str]) -> Optional[str]:
+        if key is None:
+            return None
+        if key in self._exact:
+            self._exact.move_to_end(key)
+            return self._exact[key]
+        if self._redis is not None:
+            try:
+                value = await self._redis.get(key)
+            except Exception as exc:  # pragma: no cover - 依赖外部环境
+                print(f"[ReplyCache] 读取 Redis 失败: {exc}")
+                return None
+            if value is not None:
+                self._remember_exact(key, value)
+                return value
+        return None
+
+    async def set(self, key: Optional[str], value: str) -> None:
+        if key is None:
+            return
+        self._remember_exact(key, value)
+        if self._redis is not None:
+            try:
+                await self._redis.set(key, value, ex=self.ttl)
+            except Exception as exc:  # pragma: no cover - 依赖外部环境
+                print(f"[ReplyCache] 写入 Redis 失败: {exc}")
+
+    def search(self, scope: str, embedding: np.ndarray) -> Optional[str]:
+        """在作用域内查找与 ``embedding`` 足够相似的提问，返回对应回复。"""
+
+        entry = self._semantic.get(scope)
+        if entry is None:
+            return None
+        self._semantic.move_to_end(scope)
+        vectors, replies = entry
+        scores = vectors @ _normalize(embedding)
+        best = int(np.argmax(scores))
+        if scores[best] >= self.similarity_threshold:
+            return replies[best]
+        return None
+
+    def add(self, scope: str, embedding: np.ndarray, reply: str) -> None:
+        vector = _normalize(embedding)[np.newaxis, :]
+        if scope in self._semantic:
+            vectors, replies = self._semantic[scope]
+            vectors = np.concatenate((vectors, vector))[-self.max_entries :]
+            replies = (replies + [reply])[-self.max_entries :]
+        else:
+            vectors, replies = vector, [reply]
+        self._semantic[scope] = (vectors, replies)
+        self._semantic.move_to_end(scope)
+        while len(self._semantic) > self.max_entries:
+            self._semantic.popitem(last=False)
+
+    def _remember_exact(self, key: str, value: str) -> None:
+        self._exact[key] = value
+        self._exact.move_to_end(key)
+        while len(self._exact) > self.max_entries:
+            self._exact.popitem(last=False)
+
+
+def _normalize(vector: np.ndarray) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else vector
+
+
+__all__ = ["ReplyCache", "digest"]
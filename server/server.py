@@ -9,8 +9,9 @@
 相比占位实现，本模块内置了真实可用的推理逻辑：
 
 * `WhisperStreamingRecognizer` 通过 `faster-whisper` 加载 Whisper 模型，
-  自动调用 `ffmpeg` 将浏览器发送的 WebM 音频转码为 16kHz WAV，再执行
-  语音识别。若缺少模型或 `ffmpeg`，会降级输出提示信息。
+  使用 PyAV 在进程内把浏览器发送的 WebM 音频解码为 16kHz 的 float32
+  数组，再执行语音识别（缺少 PyAV 时退回通过管道调用 `ffmpeg`）。若缺少
+  模型或解码器，会降级输出提示信息。
 * `BranchEngine` 在检测到 `OPENAI_API_KEY` 后会直接请求 OpenAI Chat
   Completions 服务，并根据回复动态生成 Galgame 风格的分支选项；若未
   配置 API Key，则回退到内建的分支模板。
@@ -20,11 +21,27 @@ OpenAI Key，整个后端即可开箱即用。
 """
 from __future__ import annotations
 
-import asyncio
 import os
+
+# BLAS/OpenMP 默认按 CPU 核数开线程，和 uvicorn、asyncio.to_thread 叠加后会
+# 造成严重的线程争用；必须在导入 numpy / faster-whisper 之前固定。真正需要
+# 多线程的推理都显式指定线程数：faster-whisper 用 ``cpu_threads``（不受这里
+# 影响），YOLO 的 Torch CPU 推理用 ``YOLO_CPU_THREADS``。
+for _var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS"):
+    os.environ.setdefault(_var, "1")
+
+import asyncio
+import io
+import json
+import math
+import re
 import shutil
+import struct
 import subprocess
-import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, AsyncIterator, Optional
 
 from fastapi import (
@@ -36,22 +53,63 @@ from fastapi import (
     WebSocket,
     WebSocketDisconnect,
 )
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+import numpy as np
 from pydantic import BaseModel, Field
 
-from .yolo_api import GenderClassifier
+from .reply_cache import ReplyCache, digest
+from .yolo_api import GenderBatcher, GenderClassifier
 
 
 class GPTRequest(BaseModel):
     prompt: Optional[str] = Field(default=None, description="最新一句话文本")
     option: Optional[str] = Field(default=None, description="选项 ID")
     history: Optional[str] = Field(default=None, description="历史上下文")
+    prefetch_id: Optional[str] = Field(default=None, description="选项确认时返回的预取 ID")
+    stream: bool = Field(default=False, description="是否以 SSE 逐段返回回复")
 
 
 class GPTResponse(BaseModel):
     text: str
     speaker: str = "系统"
     options: list[dict[str, Any]] = Field(default_factory=list)
+    prefetch_id: Optional[str] = None
+
+
+async def _replay(head: list[Any], rest: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    """先产出已经读取的片段，再继续读取剩余的流。"""
+
+    for item in head:
+        yield item
+    async for item in rest:
+        yield item
+
+
+# 关键词 → 分支选项查找表。导入时把每组关键词编译成一个正则，
+# 运行时对 casefold 后的文本做一次扫描即可判断是否命中。
+_KW_TABLE: tuple[tuple[re.Pattern[str], tuple[dict[str, str], ...]], ...] = tuple(
+    (re.compile("|".join(map(re.escape, keywords))), options)
+    for keywords, options in (
+        (
+            ("为什么", "怎么", "吗", "?", "？"),
+            (
+                {"id": "ask_more", "text": "继续追问细节"},
+                {"id": "switch", "text": "耍赖，换个话题"},
+                {"id": "promise", "text": "郑重其事地承诺"},
+            ),
+        ),
+        (
+            ("开心", "好耶", "太棒了", "great"),
+            (
+                {"id": "celebrate", "text": "一起庆祝"},
+                {"id": "tease", "text": "调皮地吐槽"},
+                {"id": "plan", "text": "约定下一步"},
+            ),
+        ),
+    )
+)
 
 
 class BranchEngine:
@@ -59,18 +117,42 @@ class BranchEngine:
 
     当检测到 ``OPENAI_API_KEY`` 环境变量时，会自动调用 OpenAI Chat
     Completions API；否则回退到预置的 Galgame 分支模板。
+
+    :meth:`stream_reply` 以流式方式请求 Chat Completions，边生成边把片段
+    转发给前端，首字延迟从整段生成的数秒降到几百毫秒；选项分支等无需
+    调用模型的情况仍走 :meth:`build_reply` 一次性返回。
+
+    玩家点选分支时会立即返回确认文本，同时在后台预取选项之后的剧情，
+    确认回复里附带 ``prefetch_id``；前端随后带着它再请求一次即可直接拿到
+    结果，两次往返的等待互相重叠。预取只存在于发起它的进程里，找不到时
+    不会把请求当成新的提问处理。
+
+    回复会写入 :class:`ReplyCache`：低温度下相同的请求直接命中精确缓存；
+    同一段历史里意思相近的提问（embedding 余弦相似度 ≥ 0.92）复用已有回复，
+    无需再次请求 API。
     """
 
-    fallback_options = [
+    fallback_options: tuple[dict[str, str], ...] = (
         {"id": "comfort", "text": "轻声安慰她"},
         {"id": "joke", "text": "装作没事讲个冷笑话"},
         {"id": "silence", "text": "只是静静陪在身旁"},
-    ]
+    )
+
+    _SYSTEM_MSG = {
+        "role": "system",
+        "content": "你是一款实时 Galgame 的剧情引擎，需要把玩家的语音转成代入感极强的对话回复，语气偏轻小说风格，长度 2~3 句。",
+    }
+    _PROMPT_CACHE_KEY = digest(_SYSTEM_MSG["content"])[:32]
 
     def __init__(self) -> None:
         self._client = None
         self._model = os.environ.get("OPENAI_MODEL", "gpt-3.5-turbo")
         self._base_url = os.environ.get("OPENAI_BASE_URL")
+        self._temperature = float(os.environ.get("OPENAI_TEMPERATURE", "0.9"))
+        self._embedding_model = os.environ.get("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+        self._semantic_cache = os.environ.get("OPENAI_SEMANTIC_CACHE", "1") != "0"
+        self._cache = ReplyCache(redis_url=os.environ.get("REDIS_URL"))
+        self._prefetched: OrderedDict[str, asyncio.Task[str]] = OrderedDict()
         api_key = os.environ.get("OPENAI_API_KEY")
         if api_key:
             try:
@@ -82,75 +164,448 @@ class BranchEngine:
 
     async def build_reply(self, request: GPTRequest) -> GPTResponse:
         if request.option:
+            prefetch_id = self._prefetch_option(request.option, request.history)
             text = f"你选择了分支【{request.option}】，剧情的因果正在悄然改变。"
-            return GPTResponse(text=text, speaker="系统", options=self.fallback_options)
+            return GPTResponse(
+                text=text, speaker="系统", options=list(self.fallback_options), prefetch_id=prefetch_id
+            )
+
+        if request.prefetch_id is not None:
+            prefetched = self._prefetched.pop(request.prefetch_id, None)
+            text = await prefetched if prefetched is not None else ""
+            return GPTResponse(text=text, speaker="AI同伴", options=list(self.fallback_options))
 
         prompt = (request.prompt or request.history or "").strip()
         if not prompt:
             return GPTResponse(
                 text="说点什么吧，只有这样我才能感知你的心情～",
                 speaker="AI同伴",
-                options=self.fallback_options,
+                options=list(self.fallback_options),
             )
 
         if not self._client:
             text = f"听到了：{prompt}\n等你配置 OPENAI_API_KEY 后，我会给出更像 Galgame 的即兴剧情。"
-            return GPTResponse(text=text, speaker="AI同伴", options=self.fallback_options)
+            return GPTResponse(text=text, speaker="AI同伴", options=list(self.fallback_options))
 
         options = self._build_dynamic_options(prompt)
         text = await self._call_openai(prompt, options, history=request.history)
-        return GPTResponse(text=text, speaker="AI同伴", options=options)
+        return GPTResponse(text=text, speaker="AI同伴", options=list(options))
 
-    async def _call_openai(self, prompt: str, options: list[dict[str, str]], *, history: Optional[str]) -> str:
-        assert self._client is not None
-        system_prompt = (
-            "你是一款实时 Galgame 的剧情引擎，需要把玩家的语音转成代入感极强的" "对话回复，语气偏轻小说风格，长度 2~3 句。"
+    async def stream_reply(self, request: GPTRequest) -> AsyncIterator[tuple[str, dict[str, Any]]]:
+        """以 ``(事件名, 数据)`` 的形式产出回复：若干 ``delta`` 片段后跟一个 ``done``。"""
+
+        prompt = (request.prompt or request.history or "").strip()
+        if request.option or request.prefetch_id is not None or not prompt or not self._client:
+            yield "done", jsonable_encoder(await self.build_reply(request))
+            return
+
+        options = self._build_dynamic_options(prompt)
+        parts: list[str] = []
+        async for delta in self._stream_openai(prompt, history=request.history):
+            parts.append(delta)
+            yield "delta", {"text": delta, "speaker": "AI同伴"}
+        response = GPTResponse(text="".join(parts).strip(), speaker="AI同伴", options=list(options))
+        yield "done", jsonable_encoder(response)
+
+    def has_prefetched(self, prefetch_id: str) -> bool:
+        return prefetch_id in self._prefetched
+
+    def _prefetch_option(self, option: str, history: Optional[str]) -> Optional[str]:
+        """在后台开始生成选项之后的剧情，返回取回结果用的 ID；未配置 API 时返回 ``None``。"""
+
+        if not self._client:
+            return None
+        prefetch_id = uuid.uuid4().hex
+        prompt = f"玩家选择了{option}"
+        self._prefetched[prefetch_id] = asyncio.create_task(
+            self._call_openai(prompt, self._build_dynamic_options(prompt), history=history)
         )
+        while len(self._prefetched) > 64:
+            _, oldest = self._prefetched.popitem(last=False)
+            oldest.cancel()
+        return prefetch_id
+
+    async def _call_openai(
+        self, prompt: str, options: tuple[dict[str, str], ...], *, history: Optional[str]
+    ) -> str:
+        parts = [delta async for delta in self._stream_openai(prompt, history=history)]
+        return "".join(parts).strip()
+
+    async def _stream_openai(self, prompt: str, *, history: Optional[str]) -> AsyncIterator[str]:
+        """逐段产出回复文本；命中缓存时一次性产出完整回复。"""
+
+        assert self._client is not None
         history_text = history or ""
         user_prompt = (
             "玩家刚刚说：" + prompt + (f"\n之前的记录：{history_text}" if history_text else "")
         )
+        messages = [
+            self._SYSTEM_MSG,
+            {"role": "user", "content": user_prompt},
+        ]
+
+        exact_key = self._cache.exact_key(self._model, messages, self._temperature)
+        cached = await self._cache.get(exact_key)
+        if cached is not None:
+            yield cached
+            return
 
+        extra: dict[str, Any] = {}
+        if not self._base_url:
+            # 让 OpenAI 服务端按系统提示词复用 KV 缓存；兼容代理未必认识该字段
+            extra["extra_body"] = {"prompt_cache_key": self._PROMPT_CACHE_KEY}
+        # embedding 查询与 API 请求同时发出，比的是 embedding 与第一段正文谁先
+        # 到（响应头先到不算）：语义缓存先命中就取消 API 请求，否则直接开始
+        # 转发回复，embedding 留到结束后写入缓存
+        scope = digest(self._model, self._SYSTEM_MSG["content"], history_text)
+        embed_task = asyncio.create_task(self._embed(prompt)) if self._semantic_cache else None
+        api_task = asyncio.create_task(self._open_stream(messages, extra))
+        if embed_task is not None:
+            await asyncio.wait({embed_task, api_task}, return_when=asyncio.FIRST_COMPLETED)
+            embedding = embed_task.result() if embed_task.done() else None
+            cached = self._cache.search(scope, embedding) if embedding is not None else None
+            if cached is not None:
+                api_task.cancel()
+                if api_task.done() and not api_task.cancelled() and api_task.exception() is None:
+                    await api_task.result()[0].close()
+                yield cached
+                return
+
+        parts: list[str] = []
+        finish_reason: Optional[str] = None
         try:
-            completion = await self._client.chat.completions.create(
-                model=self._model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt},
-                ],
-                temperature=0.9,
-                max_tokens=220,
-            )
-            return completion.choices[0].message.content.strip()
+            completion, chunks, head = await api_task
+            async for chunk in _replay(head, chunks):
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                finish_reason = choice.finish_reason or finish_reason
+                if choice.delta.content:
+                    parts.append(choice.delta.content)
+                    yield choice.delta.content
         except Exception as exc:  # pragma: no cover - 依赖外部 API
             print(f"[BranchEngine] OpenAI 调用失败: {exc}")
-            return "网络有点不稳，我暂时没能接上星界的剧情管道……"
+            if not parts:
+                yield "网络有点不稳，我暂时没能接上星界的剧情管道……"
+            return
 
-    def _build_dynamic_options(self, prompt: str) -> list[dict[str, str]]:
-        lowered = prompt.lower()
-        if any(word in lowered for word in ["为什么", "怎么", "吗", "?", "？"]):
-            return [
-                {"id": "ask_more", "text": "继续追问细节"},
-                {"id": "switch", "text": "耍赖，换个话题"},
-                {"id": "promise", "text": "郑重其事地承诺"},
-            ]
-        if any(word in lowered for word in ["开心", "好耶", "太棒了", "great"]):
-            return [
-                {"id": "celebrate", "text": "一起庆祝"},
-                {"id": "tease", "text": "调皮地吐槽"},
-                {"id": "plan", "text": "约定下一步"},
-            ]
+        text = "".join(parts).strip()
+        if not text or finish_reason != "stop":
+            # 空回复或被截断/过滤的回复不能进缓存，否则相近的提问都会拿到它
+            if embed_task is not None:
+                embed_task.cancel()
+            return
+        await self._cache.set(exact_key, text)
+        embedding = await embed_task if embed_task is not None else None
+        if embedding is not None:
+            self._cache.add(scope, embedding, text)
+
+    async def _open_stream(
+        self, messages: list[dict[str, str]], extra: dict[str, Any]
+    ) -> tuple[Any, AsyncIterator[Any], list[Any]]:
+        """发起流式请求并读到第一段正文（或流结束）为止，返回流、迭代器和已读的片段。"""
+
+        assert self._client is not None
+        completion = await self._client.chat.completions.create(
+            model=self._model,
+            messages=messages,
+            temperature=self._temperature,
+            max_tokens=220,
+            stream=True,
+            **extra,
+        )
+        chunks = completion.__aiter__()
+        head: list[Any] = []
+        try:
+            while True:
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                head.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    break
+        except BaseException:
+            # 被语义缓存抢先时任务会被取消，需要关掉已经建立的连接
+            await completion.close()
+            raise
+        return completion, chunks, head
+
+    async def _embed(self, text: str) -> Optional[np.ndarray]:
+        assert self._client is not None
+        try:
+            response = await self._client.embeddings.create(model=self._embedding_model, input=text)
+            return np.asarray(response.data[0].embedding, dtype=np.float32)
+        except Exception as exc:  # pragma: no cover - 依赖外部 API
+            print(f"[BranchEngine] 获取 embedding 失败，跳过语义缓存: {exc}")
+            return None
+
+    def _build_dynamic_options(self, prompt: str) -> tuple[dict[str, str], ...]:
+        folded = prompt.casefold()
+        for pattern, options in _KW_TABLE:
+            if pattern.search(folded):
+                return options
         return self.fallback_options
 
 
+_WEBM_CLUSTER_ID = b"\x1f\x43\xb6\x75"
+_WHISPER_CHUNK_LENGTH = 30
+_WEBM_BUFFER_BYTES = 256 * 1024
+
+
+# WebM（Matroska/EBML）中用到的元素 ID，均保留长度标记位
+_EBML_SEGMENT = 0x18538067
+_EBML_CLUSTER = 0x1F43B675
+_EBML_TRACKS = 0x1654AE6B
+_EBML_TRACK_ENTRY = 0xAE
+_EBML_CODEC_ID = 0x86
+_EBML_CODEC_PRIVATE = 0x63A2
+_EBML_AUDIO = 0xE1
+_EBML_SAMPLING_FREQUENCY = 0xB5
+_EBML_BLOCK_GROUP = 0xA0
+_EBML_BLOCK = 0xA1
+_EBML_SIMPLE_BLOCK = 0xA3
+# 这些 Master 元素不整体读取，直接进入其子元素：直播流里 Segment/Cluster 的
+# 大小是“未知”，只能边到边解析
+_EBML_DESCEND = frozenset(
+    (_EBML_SEGMENT, _EBML_CLUSTER, _EBML_TRACKS, _EBML_TRACK_ENTRY, _EBML_AUDIO, _EBML_BLOCK_GROUP)
+)
+_WEBM_AUDIO_CODECS = {"A_OPUS": "opus", "A_VORBIS": "vorbis"}
+
+
+def _read_vint(data: bytearray | bytes, pos: int, *, keep_marker: bool = False) -> Optional[tuple[int, int]]:
+    """读取 EBML 变长整数，返回 ``(值, 字节数)``；数据还不完整时返回 ``None``。"""
+
+    if pos >= len(data):
+        return None
+    first = data[pos]
+    if first == 0:
+        raise ValueError("无效的 EBML 变长整数")
+    length = 9 - first.bit_length()
+    if pos + length > len(data):
+        return None
+    value = int.from_bytes(data[pos : pos + length], "big")
+    if not keep_marker:
+        value &= (1 << (7 * length)) - 1
+    return value, length
+
+
+class _WebmStreamDecoder:
+    """增量解析 MediaRecorder 发送的 WebM 字节流，把 Block 逐个送入常驻的解码器。
+
+    每段新数据只解析和解码新到达的 Block，不会重新解码头部和整个 Cluster，
+    开销与 Cluster 长度无关。
+    """
+
+    def __init__(self, av: Any, sample_rate: int) -> None:
+        self._av = av
+        self._pending = bytearray()
+        self._codec: Any = None
+        self._codec_name: Optional[str] = None
+        self._codec_private: Optional[bytes] = None
+        self._input_rate = 48000
+        self._resampler = av.AudioResampler(format="flt", layout="mono", rate=sample_rate)
+        self._warned: set[str] = set()
+
+    def feed(self, data: bytes) -> np.ndarray:
+        self._pending += data
+        buffer = self._pending
+        frames: list[np.ndarray] = []
+        pos = 0
+        while True:
+            element_id = _read_vint(buffer, pos, keep_marker=True)
+            if element_id is None:
+                break
+            size = _read_vint(buffer, pos + element_id[1])
+            if size is None:
+                break
+            body = pos + element_id[1] + size[1]
+            if element_id[0] in _EBML_DESCEND:
+                if element_id[0] == _EBML_CLUSTER and self._codec is None:
+                    self._open_codec()
+                pos = body
+                continue
+            if body + size[0] > len(buffer):
+                break
+            self._handle(element_id[0], bytes(buffer[body : body + size[0]]), frames)
+            pos = body + size[0]
+        del buffer[:pos]
+
+        if not frames:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate(frames).astype(np.float32, copy=False)
+
+    def _handle(self, element_id: int, payload: bytes, frames: list[np.ndarray]) -> None:
+        if element_id == _EBML_CODEC_ID:
+            self._codec_name = payload.rstrip(b"\0").decode("ascii", "ignore")
+        elif element_id == _EBML_CODEC_PRIVATE:
+            self._codec_private = payload
+        elif element_id == _EBML_SAMPLING_FREQUENCY:
+            fmt = ">f" if len(payload) == 4 else ">d"
+            self._input_rate = int(struct.unpack(fmt, payload)[0])
+        elif element_id in (_EBML_SIMPLE_BLOCK, _EBML_BLOCK) and self._codec is not None:
+            self._decode_block(payload, frames)
+
+    def _open_codec(self) -> None:
+        name = _WEBM_AUDIO_CODECS.get(self._codec_name or "")
+        if name is None:
+            self._warn(f"[ASR] 不支持的 WebM 音频编码: {self._codec_name}")
+            return
+        codec = self._av.CodecContext.create(name, "r")
+        codec.sample_rate = self._input_rate
+        if self._codec_private:
+            codec.extradata = self._codec_private
+        self._codec = codec
+
+    def _decode_block(self, block: bytes, frames: list[np.ndarray]) -> None:
+        track = _read_vint(block, 0)
+        if track is None:
+            return
+        header = track[1] + 3  # 轨道号 + 2 字节相对时间码 + 1 字节标志位
+        if len(block) <= header:
+            return
+        if block[header - 1] & 0x06:
+            # MediaRecorder 的音频 Block 不使用 lacing，遇到时跳过
+            self._warn("[ASR] 暂不支持带 lacing 的 WebM Block，已跳过")
+            return
+        try:
+            for frame in self._codec.decode(self._av.Packet(block[header:])):
+                for resampled in self._resampler.resample(frame):
+                    frames.append(resampled.to_ndarray().reshape(-1))
+        except self._av.error.FFmpegError:
+            # 单个损坏的 Block 不影响后续解码
+            pass
+
+    def _warn(self, message: str) -> None:
+        if message not in self._warned:
+            self._warned.add(message)
+            print(message)
+
+
+class _BufferReader(io.RawIOBase):
+    """只读的文件对象，直接从 memoryview 读取，避免 ``io.BytesIO`` 的整块复制。"""
+
+    def __init__(self, data: bytes | memoryview) -> None:
+        super().__init__()
+        self._view = memoryview(data).cast("B")
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        size = min(len(buffer), len(self._view) - self._pos)
+        if size <= 0:
+            return 0
+        buffer[:size] = self._view[self._pos : self._pos + size]
+        self._pos += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
+# 数字里的小数点、冒号和千分位逗号（3.5、12:30、1,000）属于同一个 token，
+# 否则 _join_tokens 会把它们拆成 "3. 5"
+_TOKEN_PATTERN = re.compile(r"[A-Za-z0-9']+(?:[.:,][0-9]+)*|\S")
+
+
+def _tokenize(text: str) -> list[str]:
+    """拉丁字母按单词、中日文等按单字切分，供 local agreement 比较使用。"""
+
+    return _TOKEN_PATTERN.findall(text)
+
+
+def _join_tokens(tokens: list[str]) -> str:
+    parts: list[str] = []
+    for token in tokens:
+        if not token:
+            continue
+        if parts and token[0].isascii() and token[0].isalnum() and (
+            parts[-1][-1].isascii() and (parts[-1][-1].isalnum() or parts[-1][-1] in ",.!?;:")
+        ):
+            parts.append(" ")
+        parts.append(token)
+    return "".join(parts)
+
+
+def _strip_overlap(
+    previous: list[str], tokens: list[str], *, min_overlap: int = 2, max_overlap: int = 24
+) -> list[str]:
+    """去掉 ``tokens`` 开头与 ``previous`` 结尾重复的部分。
+
+    滚动缓冲区会把上一段音频的尾巴再识别一次，这里按 :func:`_tokenize`
+    切出的 token 比较，把重复出现的前缀裁掉，避免字幕出现叠字。至少重叠
+    ``min_overlap`` 个 token 才裁剪，以免把“了 / 了解”这类偶然相同的单字
+    或数字误删。
+    """
+
+    for size in range(min(len(previous), len(tokens), max_overlap), min_overlap - 1, -1):
+        if previous[-size:] == tokens[:size]:
+            return tokens[size:]
+    return tokens
+
+
+def _common_prefix_length(previous: list[str], current: list[str]) -> int:
+    length = 0
+    for old, new in zip(previous, current):
+        if old != new:
+            break
+        length += 1
+    return length
+
+
+# faster-whisper 1.0 的内置名称里还没有 turbo，这里映射到对应的 CTranslate2 转换版
+_WHISPER_MODEL_ALIASES = {
+    "large-v3-turbo": "mobiuslabsgmbh/faster-whisper-large-v3-turbo",
+    "turbo": "mobiuslabsgmbh/faster-whisper-large-v3-turbo",
+}
+
+
+def _default_compute_type(model_size: str, device: str) -> str:
+    """按设备和模型挑选默认精度，``WHISPER_COMPUTE_TYPE`` 可覆盖。
+
+    ==========  ================  ===========================================
+    设备        compute_type      适用场景
+    ==========  ================  ===========================================
+    cuda        ``float16``       显存充足的较新显卡（Turing 及以后），large 系列
+                                  模型首选，速度最快
+    cuda        ``int8_float16``  显存紧张或小模型，显存约为 FP16 的一半，
+                                  速度与 FP16 相近
+    cpu         ``int8``          CPU 上的唯一推荐选项，比 FP32 快数倍
+    ==========  ================  ===========================================
+    """
+
+    if device == "auto":
+        try:
+            import ctranslate2  # type: ignore
+
+            device = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+        except Exception:
+            device = "cpu"
+    if device == "cpu":
+        return "int8"
+    return "float16" if "large" in model_size else "int8_float16"
+
+
 class WhisperStreamingRecognizer:
-    """接收浏览器发来的 WebM 音频切片并转写。
+    """加载 Whisper 模型，并由 ``num_workers`` 个后台任务执行所有连接的识别请求。
 
-    识别流程：
+    每个 WebSocket 连接通过 :meth:`create_session` 拿到自己的
+    :class:`RecognitionSession`，音频缓冲、VAD 与 local agreement 等状态都
+    保存在会话里；识别器本身只持有模型和一个有界的 ``asyncio.Queue``。
+    队列满时丢弃最旧的任务，对应会话会保留音频，在下一轮重新提交。
 
-    1. 将 WebM/Opus 数据写入临时文件；
-    2. 通过 `ffmpeg` 转码为 16kHz/mono WAV；
-    3. 使用 `faster-whisper` 执行推理并返回文本。
+    音频解码由 PyAV 在内存中完成（重采样为 16kHz/mono 的 float32 数组），
+    未安装 PyAV 时退回通过标准输入输出管道调用 `ffmpeg`。
     """
 
     def __init__(
@@ -158,123 +613,485 @@ class WhisperStreamingRecognizer:
         *,
         model_size: str = "small",
         device: str = "auto",
-        min_chunk_size: int = 20_000,
         language: Optional[str] = None,
+        max_pending: int = 8,
+        audio_ctx: Optional[int] = None,
+        cpu_threads: int = 4,
+        num_workers: int = 1,
+        compute_type: Optional[str] = None,
     ) -> None:
         self.sample_rate = 16000
-        self.min_chunk_size = min_chunk_size
         self.language = language
-        self._buffer = bytearray()
-        self._lock = asyncio.Lock()
-        self._notified_placeholder = False
+        self.max_pending = max_pending
+        # CTranslate2 的每个 worker 各持有一份推理上下文，可以并行识别；这里
+        # 启动同样数量的消费任务，否则多出来的 worker 永远拿不到请求
+        self.num_workers = max(1, num_workers)
+        # ``audio_ctx`` 沿用 whisper.cpp 的单位（编码器位置数，1500 对应 30 秒），
+        # 换算成 faster-whisper 的 ``chunk_length`` 秒数来缩短送入编码器的 mel 窗口
+        self._chunk_length = max(1, math.ceil(audio_ctx / 50)) if audio_ctx else _WHISPER_CHUNK_LENGTH
+        self._queue: Optional[asyncio.Queue[tuple[np.ndarray, str, bool, asyncio.Future[Optional[str]]]]] = None
+        self._worker_tasks: list[asyncio.Task[None]] = []
         self._available = False
-        self._ffmpeg_ok = shutil.which("ffmpeg") is not None
+        self._av = None
+        try:
+            import av  # type: ignore
+
+            self._av = av
+        except ImportError:
+            pass
+        self._decoder_ok = self._av is not None or shutil.which("ffmpeg") is not None
+        # WebRTC VAD 只需几十微秒就能判断 30ms 帧是否有人声，用来在静音时
+        # 直接跳过 Whisper；未安装时退回 faster-whisper 自带的 Silero VAD。
+        self._webrtcvad = None
+        try:
+            import webrtcvad  # type: ignore
+
+            self._webrtcvad = webrtcvad
+        except ImportError:
+            print("[ASR] 未安装 webrtcvad，将使用 faster-whisper 内置的 VAD 过滤静音。")
 
         try:
             from faster_whisper import WhisperModel  # type: ignore
 
-            compute_type = os.environ.get("WHISPER_COMPUTE_TYPE")
-            if compute_type is None:
-                compute_type = "int8_float16" if device != "cpu" else "int8"
+            model_size = _WHISPER_MODEL_ALIASES.get(model_size, model_size)
+            compute_type = compute_type or _default_compute_type(model_size, device)
+            print(f"[ASR] 加载 Whisper 模型 {model_size}（device={device}, compute_type={compute_type}）")
             self._model = WhisperModel(
                 model_size,
                 device=device,
                 compute_type=compute_type,
+                cpu_threads=cpu_threads,
+                num_workers=self.num_workers,
             )
-            if self._ffmpeg_ok:
+            if self._decoder_ok:
                 self._available = True
             else:
-                print("[ASR] 未检测到 ffmpeg，可执行文件是必须的。")
+                print("[ASR] 未检测到 PyAV 或 ffmpeg，至少需要其中之一用于音频解码。")
         except Exception as exc:  # pragma: no cover - 依赖外部环境
             self._model = None
             print(f"[ASR] 初始化 Whisper 模型失败: {exc}")
 
-    async def accept_audio(self, data: bytes) -> AsyncIterator[str]:
+        if self._available:
+            self._warm_up()
+
+    @property
+    def available(self) -> bool:
+        return self._available
+
+    def create_session(self, **kwargs: Any) -> RecognitionSession:
+        vad = self._webrtcvad.Vad(kwargs.pop("vad_aggressiveness", 2)) if self._webrtcvad else None
+        return RecognitionSession(self, vad=vad, **kwargs)
+
+    async def transcribe(self, samples: np.ndarray, prompt: str = "", *, final: bool = False) -> Optional[str]:
+        """把一段 PCM 交给后台任务识别。
+
+        ``final`` 为真时使用更慢但更准的整句参数（beam search），用于一句话
+        提交前的最后一遍识别。返回 ``None`` 表示任务因队列拥堵被丢弃，
+        调用方应保留音频稍后重试。
+        """
+
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._worker_tasks = [task for task in self._worker_tasks if not task.done()]
+        while len(self._worker_tasks) < self.num_workers:
+            self._worker_tasks.append(asyncio.create_task(self._worker()))
+
+        future: asyncio.Future[Optional[str]] = asyncio.get_running_loop().create_future()
+        while self._queue.full():
+            *_, stale = self._queue.get_nowait()
+            self._queue.task_done()
+            if not stale.done():
+                stale.set_result(None)
+        self._queue.put_nowait((samples, prompt, final, future))
+        return await future
+
+    async def _worker(self) -> None:
+        assert self._queue is not None
+        while True:
+            samples, prompt, final, future = await self._queue.get()
+            try:
+                if future.done():
+                    # 连接已经断开，不必再识别
+                    continue
+                text = await asyncio.to_thread(self._transcribe_chunk, samples, prompt, final)
+                if not future.done():
+                    future.set_result(text)
+            except Exception as exc:  # pragma: no cover - 依赖外部环境
+                print(f"[ASR] 识别失败: {exc}")
+                if not future.done():
+                    future.set_result("")
+            finally:
+                self._queue.task_done()
+
+    def _warm_up(self) -> None:
+        """用 1 秒静音跑一次推理，让首个真实音频块不再承担内核初始化开销。"""
+
+        try:
+            self._run_model(
+                np.zeros(self.sample_rate, dtype=np.float32),
+                beam_size=1,
+                vad_filter=False,
+                language=self.language,
+            )
+        except Exception as exc:  # pragma: no cover - 依赖外部环境
+            print(f"[ASR] Whisper 预热失败: {exc}")
+
+    def _run_model(self, samples: np.ndarray, **options: Any) -> list[str]:
+        assert self._model is not None
+        try:
+            segments, _ = self._model.transcribe(samples, chunk_length=self._chunk_length, **options)
+            return [segment.text.strip() for segment in segments if segment.text]
+        except Exception as exc:
+            if self._chunk_length == _WHISPER_CHUNK_LENGTH:
+                raise
+            # 当前 CTranslate2 不接受缩短的编码器输入，恢复完整的 30 秒窗口
+            print(f"[ASR] 不支持缩短 audio_ctx，已恢复默认窗口: {exc}")
+            self._chunk_length = _WHISPER_CHUNK_LENGTH
+            return self._run_model(samples, **options)
+
+    def _transcribe_chunk(self, samples: np.ndarray, prompt: str = "", final: bool = False) -> str:
+        if samples.size == 0:
+            return ""
+
+        options: dict[str, Any] = {}
+        if self._webrtcvad is None:
+            options = {"vad_filter": True, "vad_parameters": {"min_silence_duration_ms": 500}}
+        if prompt:
+            # 空提示词时不传，省掉多余的前缀 token
+            options["initial_prompt"] = prompt
+        # 实时路径用贪心解码且不以前文为条件，只有整句提交时才开 beam search
+        text_parts = self._run_model(
+            samples,
+            beam_size=5 if final else 1,
+            best_of=1,
+            temperature=0.0,
+            condition_on_previous_text=False,
+            no_speech_threshold=0.5,
+            compression_ratio_threshold=2.4,
+            language=self.language,
+            **options,
+        )
+        return " ".join(text_parts).strip()
+
+    def create_stream_decoder(self) -> Optional[_WebmStreamDecoder]:
+        """有 PyAV 时返回增量解码器；否则返回 ``None``，由会话按 Cluster 调用 ffmpeg 解码。"""
+
+        return _WebmStreamDecoder(self._av, self.sample_rate) if self._av is not None else None
+
+    def decode_audio(self, chunk: bytes | memoryview) -> np.ndarray:
+        """把 WebM/Opus 字节解码为 16kHz/mono 的 float32 数组。"""
+
+        if self._av is None:
+            return self._decode_with_ffmpeg(chunk)
+
+        av = self._av
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=self.sample_rate)
+        frames: list[np.ndarray] = []
+        with av.open(_BufferReader(chunk), mode="r", metadata_errors="ignore") as container:
+            try:
+                for frame in container.decode(audio=0):
+                    for resampled in resampler.resample(frame):
+                        frames.append(resampled.to_ndarray().reshape(-1))
+            except av.error.FFmpegError:
+                # 浏览器切片末尾可能截断在半个 Block 上，保留已解码部分即可
+                pass
+        for resampled in resampler.resample(None):
+            frames.append(resampled.to_ndarray().reshape(-1))
+
+        if not frames:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate(frames).astype(np.float32, copy=False)
+
+    def _decode_with_ffmpeg(self, chunk: bytes | memoryview) -> np.ndarray:
+        cmd = [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-i",
+            "pipe:0",
+            "-f",
+            "f32le",
+            "-ac",
+            "1",
+            "-ar",
+            str(self.sample_rate),
+            "pipe:1",
+        ]
+        proc = subprocess.run(cmd, input=chunk, stdout=subprocess.PIPE, check=True)
+        return np.frombuffer(proc.stdout, dtype=np.float32)
+
+
+class RecognitionSession:
+    """单个 WebSocket 连接的流式识别状态。
+
+    识别流程：
+
+    1. 增量解析 MediaRecorder 切片中的 WebM Block，交给常驻解码器解码为
+       16kHz PCM（没有 PyAV 时按 Cluster 调用 ffmpeg）；
+    2. 追加到滚动缓冲区，新音频累计到一定长度后把整个缓冲区交给
+       :class:`WhisperStreamingRecognizer` 的后台任务识别；
+    3. 按 local agreement 策略提交文本：连续两次识别结果的公共前缀才会被
+       提交，以 ``("final", text, end)`` 输出（``text`` 只是新提交的片段），
+       其余尚未确认的部分以 ``("partial", text, False)`` 输出，前端用它覆盖
+       上一条临时字幕；已提交文本的末尾会作为 ``initial_prompt`` 喂给下一次
+       识别。一句话结束时的最后一条 final 带 ``end=True``。
+
+    当 VAD 判定说话结束或缓冲区达到 ``max_buffer_seconds`` 时，剩余文本整体
+    提交，缓冲区只保留 ``tail_seconds`` 的尾巴作为上下文。
+
+    触发长度随说话状态自适应：VAD 人声占比的指数滑动平均超过 0.6 时认为
+    正在连续说话，使用 ``active_chunk_seconds`` 快速出字；否则放宽到
+    ``steady_chunk_seconds``，两次识别之间也至少间隔同样的时长。
+    """
+
+    def __init__(
+        self,
+        recognizer: WhisperStreamingRecognizer,
+        *,
+        vad: Any = None,
+        active_chunk_seconds: float = 0.35,
+        steady_chunk_seconds: float = 0.9,
+        tail_seconds: float = 0.5,
+        max_buffer_seconds: float = 10.0,
+        min_voiced_frames: int = 3,
+    ) -> None:
+        self._recognizer = recognizer
+        self.sample_rate = recognizer.sample_rate
+        self.active_chunk_seconds = active_chunk_seconds
+        self.steady_chunk_seconds = steady_chunk_seconds
+        self.tail_samples = int(tail_seconds * self.sample_rate)
+        self.max_buffer_samples = int(max_buffer_seconds * self.sample_rate)
+        self.min_voiced_frames = min_voiced_frames
+        self._vad = vad
+        # WebM 容器状态：有 PyAV 时由 ``_stream_decoder`` 增量解析 Block 并常驻
+        # 解码器。否则退回 ffmpeg：只有第一块数据带有 EBML/Tracks 头，之后的
+        # 切片都需要拼上这段头部才能独立解码，预分配的 ``_webm_buffer`` 开头
+        # 固定存放头部，后面紧跟当前尚未结束的 Cluster。
+        self._stream_decoder = recognizer.create_stream_decoder()
+        self._webm_buffer = bytearray(_WEBM_BUFFER_BYTES if self._stream_decoder is None else 0)
+        self._write_pos = 0
+        self._header_len: Optional[int] = None
+        self._cluster_samples = 0
+        # 解码后的 PCM 滚动缓冲区，一句话提交后只保留一小段尾巴作为上下文
+        self._pcm_buffer = np.zeros(0, dtype=np.float32)
+        self._fresh_samples = 0
+        self._fresh_voiced = 0
+        self._speech_ema = 0.0
+        self.last_transcribe_time = 0.0
+        self._total_samples = 0
+        # local agreement 状态：上一次的识别结果、本句已提交的 token 数，
+        # 以及截断缓冲区时已提交的文本（用于裁掉尾巴音频重复识别出的前缀）
+        self._prev_hyp: list[str] = []
+        self._committed_count = 0
+        self._committed_tail = ""
+        self._carried_tokens: list[str] = []
+        self._last_partial = ""
+        self._utterance_open = False
+        self._notified_placeholder = False
+
+    async def accept_audio(self, data: bytes) -> AsyncIterator[tuple[str, str, bool]]:
         if not data:
             return
 
-        if not self._available:
+        if not self._recognizer.available:
             if not self._notified_placeholder:
                 self._notified_placeholder = True
-                yield "（语音识别未就绪，请检查 ffmpeg 与 Whisper 模型）"
+                yield "final", "（语音识别未就绪，请检查 PyAV/ffmpeg 与 Whisper 模型）", True
             return
 
-        self._buffer.extend(data)
-        if len(self._buffer) < self.min_chunk_size:
-            return
+        samples = await asyncio.to_thread(self._ingest_webm, data)
+        if samples.size:
+            # 这里不按 max_buffer_seconds 截断：_prev_hyp/_committed_count 按缓冲区
+            # 开头对齐，从头部丢音频会让 token 错位；达到上限时由下面的 finished
+            # 分支整句提交并只保留尾巴
+            self._pcm_buffer = self._append_pcm(self._pcm_buffer, samples)
+            self._fresh_samples += samples.size
+            self._total_samples += samples.size
+            if self._vad is not None:
+                voiced, frames = self._count_voiced(samples)
+                self._fresh_voiced += voiced
+                if frames:
+                    self._speech_ema = 0.7 * self._speech_ema + 0.3 * (voiced / frames)
 
-        if self._lock.locked():
-            # Whisper 正在处理上一块音频，避免堆积
+        cadence = self.active_chunk_seconds if self._speech_ema > 0.6 else self.steady_chunk_seconds
+        if self._fresh_samples < cadence * self.sample_rate:
             return
+        if time.monotonic() - self.last_transcribe_time < cadence:
+            return
+
+        window = self._pcm_buffer
+        window_end = self._total_samples
+        voiced = self._fresh_voiced
+        has_voice = self._vad is None or voiced >= self.min_voiced_frames
+        self.last_transcribe_time = time.monotonic()
+        prompt = self._committed_tail[-200:]
+        hypothesis: list[str] = []
+        if has_voice:
+            text = await self._recognizer.transcribe(window, prompt)
+            if text is None:
+                # 队列拥堵被丢弃：音频仍在缓冲区里，下一轮连同新数据一起识别
+                return
+            hypothesis = _strip_overlap(self._carried_tokens, _tokenize(text))
+        # 没有 webrtcvad 时由 faster-whisper 内置 VAD 过滤静音，识别结果为空即视为停顿
+        speaking = has_voice and (self._vad is not None or bool(hypothesis))
 
-        chunk = bytes(self._buffer)
-        self._buffer.clear()
+        agreed = _common_prefix_length(self._prev_hyp, hypothesis)
+        # 两次结果完全一致只说明目前为止的文本已稳定，照常提交即可；只有说话
+        # 停顿或缓冲区达到上限才算一句话结束
+        finished = not speaking or window.size >= self.max_buffer_samples
+        if finished:
+            # 一句话结束：剩余文本整体提交，缓冲区只留尾巴
+            pending = hypothesis if speaking else self._prev_hyp
+            if len(pending) > max(agreed, self._committed_count):
+                # 还有未经确认的文本，用 beam search 再识别一遍整句
+                text = await self._recognizer.transcribe(window, prompt, final=True)
+                if text is not None:
+                    pending = _strip_overlap(self._carried_tokens, _tokenize(text))
+            committed = pending[self._committed_count :]
+            partial = ""
+            keep = window[-self.tail_samples :]
+            self._prev_hyp = []
+            self._committed_count = 0
+        else:
+            committed = hypothesis[self._committed_count : agreed]
+            partial = _join_tokens(hypothesis[max(self._committed_count, agreed) :])
+            keep = window
+            self._prev_hyp = hypothesis
+            self._committed_count = max(self._committed_count, agreed)
 
-        async with self._lock:
-            text = await asyncio.to_thread(self._transcribe_chunk, chunk)
+        # 识别期间可能又收到了新音频，需要接在保留的部分后面
+        arrived = self._total_samples - window_end
+        newer = self._pcm_buffer[max(self._pcm_buffer.size - arrived, 0) :]
+        self._pcm_buffer = self._append_pcm(keep, newer)
+        self._fresh_samples = arrived
+        self._fresh_voiced -= voiced
 
+        text = _join_tokens(committed)
         if text:
-            yield text
+            self._committed_tail = _join_tokens([self._committed_tail, text])[-200:]
+        if finished:
+            self._carried_tokens = _tokenize(self._committed_tail)
+            # 本句的最后一条 final 带 end 标记（必要时文本为空），前端据此把
+            # 整句写入历史并判断是否触发分支；纯静音期间不重复发送
+            if text or self._utterance_open:
+                yield "final", text, True
+            self._utterance_open = False
+            self._last_partial = ""
+            return
+        if text:
+            self._utterance_open = True
+            yield "final", text, False
+        # 前端按“本句已提交文本 + 临时字幕”渲染，临时字幕确实变化时才发送
+        if partial != self._last_partial:
+            self._utterance_open = self._utterance_open or bool(partial)
+            yield "partial", partial, False
+        self._last_partial = partial
 
-    def _transcribe_chunk(self, chunk: bytes) -> str:
-        if not chunk:
-            return ""
+    def _append_pcm(self, buffer: np.ndarray, samples: np.ndarray) -> np.ndarray:
+        """追加 PCM；只有识别长期跟不上、缓冲区超过上限两倍时才从头部丢弃。
 
-        assert self._model is not None
-        src_fd, src_path = tempfile.mkstemp(suffix=".webm")
-        dst_fd, dst_path = tempfile.mkstemp(suffix=".wav")
-        try:
-            with os.fdopen(src_fd, "wb") as src_file:
-                src_file.write(chunk)
-
-            os.close(dst_fd)
-            cmd = [
-                "ffmpeg",
-                "-loglevel",
-                "error",
-                "-y",
-                "-i",
-                src_path,
-                "-ac",
-                "1",
-                "-ar",
-                str(self.sample_rate),
-                dst_path,
-            ]
-            subprocess.run(cmd, check=True)
-
-            segments, _ = self._model.transcribe(
-                dst_path,
-                beam_size=3,
-                temperature=0.2,
-                vad_filter=True,
-                vad_parameters={"min_silence_duration_ms": 500},
-                language=self.language,
-            )
-            text_parts = [segment.text.strip() for segment in segments if segment.text]
-            return " ".join(text_parts).strip()
-        except subprocess.CalledProcessError as exc:
-            print(f"[ASR] ffmpeg 转码失败: {exc}")
-            return ""
-        finally:
-            for path in (src_path, dst_path):
-                try:
-                    os.unlink(path)
-                except OSError:
-                    pass
+        这种情况下 local agreement 的 token 已无法与缓冲区对齐，直接放弃本句
+        尚未确认的结果，改用已提交文本裁掉重复识别出的前缀。
+        """
+
+        merged = np.concatenate((buffer, samples))
+        if merged.size <= 2 * self.max_buffer_samples:
+            return merged
+        self._prev_hyp = []
+        self._committed_count = 0
+        self._carried_tokens = _tokenize(self._committed_tail)
+        return merged[-self.max_buffer_samples :]
+
+    def _ingest_webm(self, data: bytes) -> np.ndarray:
+        """解码一段 MediaRecorder 切片，返回其中新增的 PCM 样本。
+
+        有 PyAV 时交给 :class:`_WebmStreamDecoder`，只解码新到达的 Block。
+        退回 ffmpeg 时按 Cluster 切分字节流：已结束的 Cluster 解码一次后丢弃，
+        未结束的 Cluster 每次连同头部一起重新解码，只取出上次之后新增的样本。
+        """
+
+        if self._stream_decoder is not None:
+            try:
+                return self._stream_decoder.feed(data)
+            except Exception as exc:
+                print(f"[ASR] 音频解码失败: {exc}")
+                return np.zeros(0, dtype=np.float32)
+
+        end = self._write_pos + len(data)
+        if end > len(self._webm_buffer):
+            # 超长 Cluster 极少出现，换一块更大的缓冲区（不能原地扩容，
+            # 解码器可能仍持有旧缓冲区的 memoryview）
+            grown = bytearray(max(end, 2 * len(self._webm_buffer)))
+            grown[: self._write_pos] = memoryview(self._webm_buffer)[: self._write_pos]
+            self._webm_buffer = grown
+        buffer = self._webm_buffer
+        memoryview(buffer)[self._write_pos : end] = data
+        self._write_pos = end
+
+        if self._header_len is None:
+            start = buffer.find(_WEBM_CLUSTER_ID, 0, self._write_pos)
+            if start < 0:
+                return np.zeros(0, dtype=np.float32)
+            self._header_len = start
+        header_len = self._header_len
+
+        parts: list[np.ndarray] = []
+        while True:
+            boundary = buffer.find(_WEBM_CLUSTER_ID, header_len + 1, self._write_pos)
+            cluster_end = self._write_pos if boundary < 0 else boundary
+            try:
+                samples = self._recognizer.decode_audio(memoryview(buffer)[:cluster_end])
+            except Exception as exc:
+                print(f"[ASR] 音频解码失败: {exc}")
+                samples = np.zeros(0, dtype=np.float32)
+            if samples.size > self._cluster_samples:
+                parts.append(samples[self._cluster_samples :])
+            if boundary < 0:
+                self._cluster_samples = max(self._cluster_samples, samples.size)
+                break
+            # 已结束的 Cluster 不再需要，把剩余数据挪到头部之后
+            rest = bytes(memoryview(buffer)[boundary : self._write_pos])
+            buffer[header_len : header_len + len(rest)] = rest
+            self._write_pos = header_len + len(rest)
+            self._cluster_samples = 0
+
+        if not parts:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate(parts)
+
+    def _count_voiced(self, samples: np.ndarray) -> tuple[int, int]:
+        """按 30ms 帧跑 WebRTC VAD，返回 ``(人声帧数, 总帧数)``。"""
+
+        assert self._vad is not None
+        frame_size = self.sample_rate * 30 // 1000
+        usable = samples.size - samples.size % frame_size
+        if usable == 0:
+            return 0, 0
+        pcm = (np.clip(samples[:usable], -1.0, 1.0) * 32767).astype(np.int16)
+        frames = pcm.reshape(-1, frame_size)
+        voiced = sum(1 for frame in frames if self._vad.is_speech(frame.tobytes(), self.sample_rate))
+        return voiced, len(frames)
 
 
 WHISPER_MODEL_SIZE = os.environ.get("WHISPER_MODEL_SIZE", "small")
 WHISPER_DEVICE = os.environ.get("WHISPER_DEVICE", "auto")
 WHISPER_LANGUAGE = os.environ.get("WHISPER_LANGUAGE")
+WHISPER_CPU_THREADS = int(os.environ.get("WHISPER_CPU_THREADS", "4"))
+WHISPER_NUM_WORKERS = int(os.environ.get("WHISPER_NUM_WORKERS", "1"))
+WHISPER_COMPUTE_TYPE = os.environ.get("WHISPER_COMPUTE_TYPE")
+WHISPER_AUDIO_CTX = int(os.environ["WHISPER_AUDIO_CTX"]) if os.environ.get("WHISPER_AUDIO_CTX") else None
+YOLO_EXPORT_FORMAT = os.environ.get("YOLO_EXPORT_FORMAT", "none")
+YOLO_CPU_THREADS = int(os.environ.get("YOLO_CPU_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))
 
-branch_engine = BranchEngine()
-recognizer = WhisperStreamingRecognizer(
-    model_size=WHISPER_MODEL_SIZE,
-    device=WHISPER_DEVICE,
-    language=WHISPER_LANGUAGE,
-)
-gender_classifier = GenderClassifier(weights=os.environ.get("YOLO_WEIGHTS"))
+# 模型与引擎都在 startup 事件里创建：以 `--workers N` 启动时每个 uvicorn worker
+# 进程各自加载一份 Whisper/YOLO 模型并独占自己的推理队列，不同连接不再在同一个
+# 进程的 GIL 与队列上互相排队；`python -m server.server` 的父进程和 uvicorn 的
+# supervisor 只导入模块，不会白白加载一次模型
+branch_engine: Optional[BranchEngine] = None
+recognizer: Optional[WhisperStreamingRecognizer] = None
+gender_classifier: Optional[GenderClassifier] = None
+yolo_executor: Optional[ThreadPoolExecutor] = None
+gender_batcher: Optional[GenderBatcher] = None
 
 app = FastAPI(title="Live Galgame Agent")
 
@@ -287,6 +1104,43 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def load_models() -> None:
+    global branch_engine, recognizer, gender_classifier, yolo_executor, gender_batcher
+    branch_engine = BranchEngine()
+    recognizer = WhisperStreamingRecognizer(
+        model_size=WHISPER_MODEL_SIZE,
+        device=WHISPER_DEVICE,
+        language=WHISPER_LANGUAGE,
+        audio_ctx=WHISPER_AUDIO_CTX,
+        cpu_threads=WHISPER_CPU_THREADS,
+        num_workers=WHISPER_NUM_WORKERS,
+        compute_type=WHISPER_COMPUTE_TYPE,
+    )
+    gender_classifier = GenderClassifier(
+        weights=os.environ.get("YOLO_WEIGHTS"),
+        export_format=None if YOLO_EXPORT_FORMAT == "none" else YOLO_EXPORT_FORMAT,
+        cpu_threads=YOLO_CPU_THREADS,
+    )
+    # YOLO 推理是同步的 Torch 调用，放到独立线程中执行，避免阻塞事件循环（进而
+    # 卡住 /ws_asr）。ultralytics 的 predictor 与 TensorRT 执行上下文都不是线程
+    # 安全的，同一个模型只能串行推理，吞吐靠 GenderBatcher 合并批量推理弥补
+    yolo_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="yolo")
+    gender_batcher = GenderBatcher(gender_classifier, executor=yolo_executor, max_concurrency=1)
+
+
+@app.on_event("shutdown")
+async def release_models() -> None:
+    if yolo_executor is not None:
+        yolo_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _require(component: Optional[Any], name: str) -> Any:
+    if component is None:
+        raise HTTPException(status_code=503, detail=f"{name}尚未初始化")
+    return component
+
+
 @app.get("/")
 async def root() -> dict[str, str]:
     return {"status": "ok"}
@@ -295,6 +1149,10 @@ async def root() -> dict[str, str]:
 @app.websocket("/ws_asr")
 async def ws_asr(websocket: WebSocket) -> None:
     await websocket.accept()
+    if recognizer is None:
+        await websocket.close(code=1011, reason="语音识别尚未初始化")
+        return
+    session = recognizer.create_session()
     try:
         while True:
             message = await websocket.receive()
@@ -305,8 +1163,8 @@ async def ws_asr(websocket: WebSocket) -> None:
             if data is None:
                 continue
 
-            async for text in recognizer.accept_audio(data):
-                payload = {"text": text, "speaker": "主角"}
+            async for kind, text, end in session.accept_audio(data):
+                payload = {"type": kind, "text": text, "end": end, "speaker": "主角"}
                 await websocket.send_json(payload)
     except WebSocketDisconnect:
         pass
@@ -315,8 +1173,19 @@ async def ws_asr(websocket: WebSocket) -> None:
 
 
 @app.post("/gpt", response_model=GPTResponse)
-async def gpt_endpoint(request: GPTRequest = Body(...)) -> GPTResponse:
-    return await branch_engine.build_reply(request)
+async def gpt_endpoint(request: GPTRequest = Body(...)) -> GPTResponse | Response:
+    engine: BranchEngine = _require(branch_engine, "剧情引擎")
+    if request.prefetch_id is not None and not engine.has_prefetched(request.prefetch_id):
+        # 预取已被取走、被淘汰，或请求落到了另一个 worker：没有后续剧情可返回
+        return Response(status_code=204)
+    if request.stream:
+        return StreamingResponse(_format_sse(engine.stream_reply(request)), media_type="text/event-stream")
+    return await engine.build_reply(request)
+
+
+async def _format_sse(events: AsyncIterator[tuple[str, dict[str, Any]]]) -> AsyncIterator[str]:
+    async for event, data in events:
+        yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 
 @app.post("/yolo_gender")
@@ -324,11 +1193,20 @@ async def yolo_gender(file: UploadFile = File(...)) -> dict[str, Any]:
     image_bytes = await file.read()
     if not image_bytes:
         raise HTTPException(status_code=400, detail="未收到有效的图像数据")
-    result = gender_classifier.classify(image_bytes)
+    batcher: GenderBatcher = _require(gender_batcher, "性别识别")
+    result = await batcher.classify(image_bytes)
     return result.to_dict()
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", "8000")))
+    # 多 worker 模式下 uvicorn 需要以导入路径的形式加载应用
+    uvicorn.run(
+        "server.server:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8000")),
+        workers=int(os.environ.get("WEB_CONCURRENCY", "2")),
+        loop="uvloop",
+        ws="websockets",
+    )
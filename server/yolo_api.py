@@ -4,12 +4,33 @@
 FastAPI 服务。默认实现为占位逻辑，始终返回 "female"，
 方便在本地快速跑通流程；当安装了真实的 YOLO 模型（例如
 ultralytics>=8.0）时，可以通过传入模型权重路径来启用真·推理。
+
+指定 ``export_format`` 后，加载权重时会把模型导出为 TensorRT 或 ONNX 引擎并
+缓存在 ``~/.cache/live_galgame/`` 下（缓存键包含权重文件的哈希），之后的启动
+直接复用导出结果；导出失败时继续使用原始的 Torch 模型。导出需要额外安装
+``tensorrt`` 或 ``onnx``/``onnxruntime``，因此默认关闭。
+
+``GenderBatcher`` 会把约 10ms 内到达的请求合并成一个 batch，一次前向推理
+处理多张图片，提高多客户端同时请求时的 GPU 利用率。
 """
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import os
+import shutil
+from concurrent.futures import Executor
 from dataclasses import dataclass
+from pathlib import Path
 from typing import Optional
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows 下没有 fcntl，导出时不加锁
+    fcntl = None
+
+CACHE_DIR = Path.home() / ".cache" / "live_galgame"
+
 
 @dataclass
 class GenderResult:
@@ -31,6 +52,19 @@ class GenderClassifier:
         指定推理设备，例如 "cuda" 或 "cpu"。
     conf_threshold: float
         置信度阈值，默认 0.7。
+    imgsz: int
+        推理输入尺寸，默认 320；性别检测只需要大致的人像区域，较小的输入
+        能明显降低计算量。
+    half: bool
+        在 CUDA 设备上使用 FP16 推理，CPU 上会自动忽略。
+    export_format: Optional[str]
+        导出的推理引擎格式：``"auto"``（有 CUDA 用 ``"engine"``，否则
+        ``"onnx"``）、``"engine"``、``"onnx"``；默认 ``None`` 不导出。
+    max_batch: int
+        单次推理最多处理的图片数，导出引擎时作为动态 batch 的上限。
+    cpu_threads: Optional[int]
+        CPU 推理时 Torch 使用的线程数。服务端为了避免 BLAS 线程争用会把
+        ``OMP_NUM_THREADS`` 固定为 1，这里显式设置，CPU 推理才不会退化成单线程。
     """
 
     def __init__(
@@ -39,19 +73,44 @@ class GenderClassifier:
         *,
         device: Optional[str] = None,
         conf_threshold: float = 0.7,
+        imgsz: int = 320,
+        half: bool = True,
+        export_format: Optional[str] = None,
+        max_batch: int = 8,
+        cpu_threads: Optional[int] = None,
     ) -> None:
         self.conf_threshold = conf_threshold
+        self.imgsz = imgsz
+        self.max_batch = max_batch
         self._available = False
         self._model = None
         self._device = device
+        self._half = False
+        self._cv2 = None
+        self._np = None
 
         if weights:
             try:
+                import cv2  # type: ignore
+                import numpy as np
+                import torch  # type: ignore
                 from ultralytics import YOLO  # type: ignore
 
+                self._cv2 = cv2
+                self._np = np
                 self._model = YOLO(weights)
                 if device:
                     self._model.to(device)
+                target = device or ("cuda" if torch.cuda.is_available() else "cpu")
+                if cpu_threads:
+                    torch.set_num_threads(cpu_threads)
+                self._half = half and target.startswith("cuda")
+                if export_format == "auto":
+                    export_format = "engine" if target.startswith("cuda") else "onnx"
+                if export_format:
+                    engine = self._load_exported(YOLO, weights, export_format)
+                    if engine is not None:
+                        self._model = engine
                 self._available = True
             except Exception as exc:  # pragma: no cover - 依赖外部环境
                 # 打印警告但不中断流程
@@ -61,32 +120,95 @@ class GenderClassifier:
     def available(self) -> bool:
         return self._available
 
+    def _load_exported(self, yolo_cls, weights: str, export_format: str):
+        """返回导出并缓存后的推理引擎，失败时返回 ``None``。"""
+
+        suffix = ".engine" if export_format == "engine" else ".onnx"
+        precision = "fp16" if self._half else "fp32"
+        name = f"{Path(weights).stem}-{_weights_digest(weights)}-{self.imgsz}-b{self.max_batch}-{precision}"
+        cached = CACHE_DIR / f"{name}{suffix}"
+        try:
+            if not cached.exists():
+                CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                # 多个 uvicorn worker 会同时走到这里：加文件锁串行导出，拿到锁后
+                # 再检查一次缓存；先写临时文件再 os.replace，其他进程不会读到
+                # 复制了一半的引擎
+                with open(CACHE_DIR / f"{name}.lock", "w") as lock:
+                    if fcntl is not None:
+                        fcntl.flock(lock, fcntl.LOCK_EX)
+                    if not cached.exists():
+                        exported = self._model.export(
+                            format=export_format,
+                            imgsz=self.imgsz,
+                            half=self._half,
+                            dynamic=True,
+                            batch=self.max_batch,
+                            device=self._device,
+                            verbose=False,
+                        )
+                        partial = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+                        shutil.move(str(exported), partial)
+                        os.replace(partial, cached)
+            return yolo_cls(str(cached), task="detect")
+        except Exception as exc:  # pragma: no cover - 依赖外部环境
+            print(f"[GenderClassifier] 导出 {export_format} 引擎失败，继续使用 Torch 模型: {exc}")
+            return None
+
     def classify(self, image_bytes: bytes) -> GenderResult:
         """对输入图片进行性别识别。
 
         当未成功加载模型时，返回一个默认结果，确保流程不中断。
         """
 
-        if not image_bytes:
-            return GenderResult(label="unknown", confidence=0.0)
+        return self.classify_batch([image_bytes])[0]
+
+    def classify_batch(self, images: list[bytes]) -> list[GenderResult]:
+        """对多张图片做一次批量推理，结果顺序与输入一致。"""
 
+        results = [GenderResult(label="unknown", confidence=0.0) for _ in images]
         if not self._available:
             # 默认假定是女性，避免频繁误报
-            return GenderResult(label="female", confidence=0.95)
+            return [
+                GenderResult(label="female", confidence=0.95) if image_bytes else result
+                for image_bytes, result in zip(images, results)
+            ]
 
-        predictions = self._model.predict(source=image_bytes, save=False, verbose=False)
+        # 先用 OpenCV 解码成 BGR 数组，避免 ultralytics 每次重新嗅探输入类型
+        decoded: list[tuple[int, object]] = []
+        for index, image_bytes in enumerate(images):
+            if not image_bytes:
+                continue
+            buffer = self._np.frombuffer(image_bytes, dtype=self._np.uint8)
+            image = self._cv2.imdecode(buffer, self._cv2.IMREAD_COLOR)
+            if image is not None:
+                decoded.append((index, image))
+        if not decoded:
+            return results
+
+        predictions = self._model.predict(
+            source=[image for _, image in decoded],
+            imgsz=self.imgsz,
+            half=self._half,
+            device=self._device,
+            save=False,
+            verbose=False,
+        )
+        for (index, _), pred in zip(decoded, predictions):
+            results[index] = self._parse_prediction(pred)
+        return results
+
+    def _parse_prediction(self, pred) -> GenderResult:
         best_label = "unknown"
         best_conf = 0.0
 
-        for pred in predictions:
-            for box in pred.boxes:  # type: ignore[attr-defined]
-                cls = int(box.cls)
-                conf = float(box.conf)
-                # 约定 0 为 female, 1 为 male
-                label = "female" if cls == 0 else "male"
-                if conf > best_conf:
-                    best_label = label
-                    best_conf = conf
+        for box in pred.boxes:  # type: ignore[attr-defined]
+            cls = int(box.cls)
+            conf = float(box.conf)
+            # 约定 0 为 female, 1 为 male
+            label = "female" if cls == 0 else "male"
+            if conf > best_conf:
+                best_label = label
+                best_conf = conf
 
         if best_conf < self.conf_threshold:
             best_label = "unknown"
@@ -94,4 +216,102 @@ class GenderClassifier:
         return GenderResult(label=best_label, confidence=best_conf)
 
 
-__all__ = ["GenderClassifier", "GenderResult"]
+def _weights_digest(weights: str) -> str:
+    """权重文件内容的短哈希；同名的不同权重或重新训练后的权重不会复用旧引擎。"""
+
+    path = Path(weights)
+    sha = hashlib.sha256()
+    if path.is_file():
+        with path.open("rb") as handle:
+            for block in iter(lambda: handle.read(1 << 20), b""):
+                sha.update(block)
+    else:
+        # ultralytics 的内置模型名（如 yolov8n.pt）不一定已下载到本地
+        sha.update(weights.encode("utf-8"))
+    return sha.hexdigest()[:12]
+
+
+class GenderBatcher:
+    """把短时间内到达的识别请求合并成批量推理。
+
+    Parameters
+    ----------
+    classifier: GenderClassifier
+        实际执行推理的分类器。
+    executor: Optional[Executor]
+        运行同步推理的线程池，``None`` 表示使用事件循环默认的线程池。
+    max_wait: float
+        收到第一张图片后最多再等待的秒数，默认 10ms。
+    max_concurrency: int
+        同时在线程池中执行的 batch 数量上限，默认 1。同一个 YOLO 模型（包括
+        导出的 TensorRT 引擎）不能被多个线程同时调用，只有每个线程各持有
+        一份模型时才应调大。
+    """
+
+    def __init__(
+        self,
+        classifier: GenderClassifier,
+        *,
+        executor: Optional[Executor] = None,
+        max_wait: float = 0.01,
+        max_concurrency: int = 1,
+    ) -> None:
+        self.classifier = classifier
+        self.max_wait = max_wait
+        self._executor = executor
+        self._max_concurrency = max_concurrency
+        self._queue: Optional[asyncio.Queue[tuple[bytes, asyncio.Future[GenderResult]]]] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._worker_task: Optional[asyncio.Task[None]] = None
+        self._running: set[asyncio.Task[None]] = set()
+
+    async def classify(self, image_bytes: bytes) -> GenderResult:
+        if self._queue is None or self._slots is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self._max_concurrency)
+        if self._worker_task is None or self._worker_task.done():
+            self._worker_task = asyncio.create_task(self._worker())
+
+        future: asyncio.Future[GenderResult] = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((image_bytes, future))
+        return await future
+
+    async def _worker(self) -> None:
+        assert self._queue is not None and self._slots is not None
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.classifier.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # 线程池满时在这里等待，期间新请求继续在队列里累积成下一个 batch
+            await self._slots.acquire()
+            task = asyncio.create_task(self._run_batch(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run_batch(self, batch: list[tuple[bytes, asyncio.Future[GenderResult]]]) -> None:
+        assert self._slots is not None
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self._executor, self.classifier.classify_batch, [image for image, _ in batch]
+            )
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as exc:  # pragma: no cover - 依赖外部环境
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+        finally:
+            self._slots.release()
+
+
+__all__ = ["GenderBatcher", "GenderClassifier", "GenderResult"]
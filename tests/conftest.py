@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# 让测试可以直接 `import server.server`，与 deploy.sh 中的 PYTHONPATH 一致
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
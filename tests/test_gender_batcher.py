@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from server.yolo_api import GenderBatcher, GenderResult
+
+
+class StubClassifier:
+    max_batch = 4
+
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    def classify_batch(self, images):
+        self.batches.append(list(images))
+        if self.error is not None:
+            raise self.error
+        return [GenderResult(label=image.decode(), confidence=1.0) for image in images]
+
+
+def test_results_follow_request_order_across_batches():
+    classifier = StubClassifier()
+    batcher = GenderBatcher(classifier, max_wait=0.05)
+    images = [str(i).encode() for i in range(6)]
+
+    async def run():
+        return await asyncio.gather(*(batcher.classify(image) for image in images))
+
+    results = asyncio.run(run())
+
+    assert [result.label for result in results] == [str(i) for i in range(6)]
+    assert [len(batch) for batch in classifier.batches] == [4, 2]
+
+
+def test_batch_errors_reach_every_caller():
+    classifier = StubClassifier(error=RuntimeError("推理失败"))
+    batcher = GenderBatcher(classifier, max_wait=0.05)
+
+    async def run():
+        return await asyncio.gather(
+            *(batcher.classify(b"x") for _ in range(3)), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert len(classifier.batches) == 1
+
+
+def test_batcher_recovers_after_a_failed_batch():
+    classifier = StubClassifier(error=RuntimeError("推理失败"))
+    batcher = GenderBatcher(classifier, max_wait=0.01)
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await batcher.classify(b"a")
+        classifier.error = None
+        return await batcher.classify(b"b")
+
+    assert asyncio.run(run()).label == "b"
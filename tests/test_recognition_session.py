@@ -0,0 +1,115 @@
+import asyncio
+
+import numpy as np
+
+from server.server import RecognitionSession
+
+
+class StubDecoder:
+    """每条消息解码出一秒音频。"""
+
+    def feed(self, data):
+        return np.zeros(16000, dtype=np.float32)
+
+
+class StubRecognizer:
+    sample_rate = 16000
+    available = True
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.calls = []
+
+    def create_stream_decoder(self):
+        return StubDecoder()
+
+    async def transcribe(self, samples, prompt="", *, final=False):
+        self.calls.append(final)
+        return self.script.pop(0) if self.script else ""
+
+
+class StubVad:
+    def __init__(self):
+        self.speaking = True
+
+    def is_speech(self, frame, sample_rate):
+        return self.speaking
+
+
+def make_session(script, **kwargs):
+    recognizer = StubRecognizer(script)
+    vad = StubVad()
+    session = RecognitionSession(
+        recognizer, vad=vad, active_chunk_seconds=0.0, steady_chunk_seconds=0.0, **kwargs
+    )
+    return session, recognizer, vad
+
+
+def feed(session):
+    async def collect():
+        return [event async for event in session.accept_audio(b"chunk")]
+
+    return asyncio.run(collect())
+
+
+def test_continuous_speech_commits_agreed_prefix_without_ending():
+    session, _, _ = make_session(["明", "明", "明天", "明天见", "明天见"])
+    events = [event for _ in range(5) for event in feed(session)]
+
+    assert all(not end for _, _, end in events)
+    assert "".join(text for kind, text, _ in events if kind == "final") == "明天见"
+    assert events[0] == ("partial", "明", False)
+
+
+def test_pause_ends_the_utterance_once():
+    session, recognizer, vad = make_session(["你好吗", "你好吗"])
+    feed(session)
+    feed(session)
+    vad.speaking = False
+
+    assert feed(session) == [("final", "", True)]
+    # 之后的静音不再重复发送结束标记，也不会调用 Whisper
+    assert feed(session) == []
+    assert recognizer.calls == [False, False]
+
+
+def test_pause_commits_unconfirmed_text_with_final_pass():
+    session, recognizer, vad = make_session(["今天", "今天天气", "今天天气很好"])
+    feed(session)
+    feed(session)
+    vad.speaking = False
+
+    events = feed(session)
+
+    assert events == [("final", "天气很好", True)]
+    assert recognizer.calls == [False, False, True]
+
+
+def test_buffer_cap_ends_the_utterance():
+    session, recognizer, _ = make_session(["一", "一二", "一二三"], max_buffer_seconds=2.0)
+    assert feed(session) == [("partial", "一", False)]
+
+    events = feed(session)
+
+    assert events[-1][2] is True
+    assert "".join(text for kind, text, _ in events if kind == "final") == "一二三"
+    assert recognizer.calls[-1] is True
+
+
+def test_silence_only_emits_nothing():
+    session, recognizer, vad = make_session(["不应出现"])
+    vad.speaking = False
+
+    assert feed(session) == []
+    assert feed(session) == []
+    assert recognizer.calls == []
+
+
+def test_unavailable_recognizer_reports_once():
+    session, _, _ = make_session([])
+    session._recognizer.available = False
+
+    events = feed(session)
+
+    assert len(events) == 1 and events[0][0] == "final" and events[0][2] is True
+    assert feed(session) == []
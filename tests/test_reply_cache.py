@@ -0,0 +1,76 @@
+import asyncio
+
+import numpy as np
+
+from server.reply_cache import ReplyCache, digest
+
+MESSAGES = [{"role": "user", "content": "你好"}]
+
+
+def test_exact_get_and_set():
+    cache = ReplyCache()
+    key = cache.exact_key("gpt", MESSAGES, 0.0)
+
+    async def run():
+        assert await cache.get(key) is None
+        await cache.set(key, "你好呀")
+        return await cache.get(key)
+
+    assert asyncio.run(run()) == "你好呀"
+
+
+def test_exact_key_depends_on_model_messages_and_temperature():
+    cache = ReplyCache()
+    key = cache.exact_key("gpt", MESSAGES, 0.0)
+    assert key != cache.exact_key("other", MESSAGES, 0.0)
+    assert key != cache.exact_key("gpt", [{"role": "user", "content": "再见"}], 0.0)
+    assert key != cache.exact_key("gpt", MESSAGES, 0.2)
+
+
+def test_high_temperature_skips_exact_cache():
+    cache = ReplyCache(max_exact_temperature=0.3)
+    key = cache.exact_key("gpt", MESSAGES, 0.9)
+    assert key is None
+
+    async def run():
+        await cache.set(key, "不会被缓存")
+        return await cache.get(key)
+
+    assert asyncio.run(run()) is None
+
+
+def test_exact_cache_evicts_least_recently_used():
+    cache = ReplyCache(max_entries=2)
+    keys = [cache.exact_key("gpt", [{"role": "user", "content": str(i)}], 0.0) for i in range(3)]
+
+    async def run():
+        await cache.set(keys[0], "0")
+        await cache.set(keys[1], "1")
+        await cache.get(keys[0])
+        await cache.set(keys[2], "2")
+        return [await cache.get(key) for key in keys]
+
+    assert asyncio.run(run()) == ["0", None, "2"]
+
+
+def test_semantic_search_respects_threshold():
+    cache = ReplyCache(similarity_threshold=0.92)
+    cache.add("scope", np.array([1.0, 0.0, 0.0]), "相近的回复")
+
+    assert cache.search("scope", np.array([0.99, 0.1, 0.0])) == "相近的回复"
+    assert cache.search("scope", np.array([0.7, 0.7, 0.0])) is None
+    assert cache.search("scope", np.array([0.0, 1.0, 0.0])) is None
+
+
+def test_semantic_search_is_scoped_and_picks_best_match():
+    cache = ReplyCache()
+    cache.add("scope", np.array([1.0, 0.0]), "甲")
+    cache.add("scope", np.array([0.0, 1.0]), "乙")
+
+    assert cache.search("scope", np.array([0.05, 2.0])) == "乙"
+    assert cache.search("other", np.array([0.0, 1.0])) is None
+
+
+def test_digest_is_stable_for_equal_content():
+    assert digest({"a": 1, "b": 2}) == digest({"b": 2, "a": 1})
+    assert digest("x") != digest("y")
@@ -0,0 +1,44 @@
+from server.server import _common_prefix_length, _join_tokens, _strip_overlap, _tokenize
+
+
+def test_tokenize_splits_words_and_cjk_characters():
+    assert _tokenize("你好 hello world!") == ["你", "好", "hello", "world", "!"]
+
+
+def test_tokenize_keeps_numbers_with_separators_together():
+    assert _tokenize("3.5元") == ["3.5", "元"]
+    assert _tokenize("12:30 or 1,000.") == ["12:30", "or", "1,000", "."]
+
+
+def test_join_tokens_round_trips_numbers():
+    for text in ("3.5", "12:30", "1,000", "下午3:15见", "ok, 2.5 kg"):
+        assert _join_tokens(_tokenize(text)) == text
+
+
+def test_strip_overlap_removes_repeated_prefix():
+    previous = _tokenize("今天天气很好")
+    assert _strip_overlap(previous, _tokenize("天气很好吗")) == ["吗"]
+    assert _strip_overlap(_tokenize("it is fine"), _tokenize("is fine today")) == ["today"]
+
+
+def test_strip_overlap_keeps_single_token_coincidences():
+    assert _join_tokens(_strip_overlap(_tokenize("it is 1"), _tokenize("10 apples"))) == "10 apples"
+    assert _join_tokens(_strip_overlap(_tokenize("我们走了"), _tokenize("了解一下"))) == "了解一下"
+
+
+def test_strip_overlap_without_previous_text():
+    assert _strip_overlap([], _tokenize("你好")) == ["你", "好"]
+    assert _strip_overlap(_tokenize("你好"), []) == []
+
+
+def test_join_tokens_spaces_latin_words_only():
+    assert _join_tokens(["你", "好", "hello", "world", "!"]) == "你好hello world!"
+    assert _join_tokens(["ok", ",", "go"]) == "ok, go"
+    assert _join_tokens([]) == ""
+
+
+def test_common_prefix_length():
+    assert _common_prefix_length(["a", "b", "c"], ["a", "b", "d"]) == 2
+    assert _common_prefix_length(["a", "b"], ["a", "b", "c"]) == 2
+    assert _common_prefix_length([], ["a"]) == 0
+    assert _common_prefix_length(["x"], ["y"]) == 0